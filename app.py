@@ -3,11 +3,21 @@ Flask Web Interface with Database Integration
 Handles authentication, patient management, and prescriptions
 """
 
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
-from werkzeug.utils import secure_filename
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, g
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
+import atexit
+import hashlib
+import io
+import json
 import os
-from datetime import datetime, timedelta
+import shutil
+import tempfile
+import time
+import uuid
+from datetime import timedelta
+from functools import wraps
 import secrets
+from concurrent.futures import ThreadPoolExecutor
 from prescription_summarizer import PrescriptionSummarizer
 from database_models import Database
 from dotenv import load_dotenv
@@ -19,33 +29,145 @@ app.config['UPLOAD_FOLDER'] = './uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=12)
 
+# Create necessary directories (also needed when started by gunicorn)
+os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
 # Initialize systems
 API_KEY = os.getenv("GEMINI_API_KEY")
 if not API_KEY:
     print("⚠️  WARNING: GEMINI_API_KEY not found!")
     print("Get free key: https://makersuite.google.com/app/apikey")
 
-summarizer = PrescriptionSummarizer(api_key=API_KEY)
+# Prescriptions are processed off the request thread (OCR + LLM take seconds)
+PROCESSING_WORKERS = int(os.getenv('PROCESSING_WORKERS', 2))
+
+summarizer = PrescriptionSummarizer(api_key=API_KEY, concurrent_jobs=PROCESSING_WORKERS)
 db = Database()
 
-ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg'}
+executor = ThreadPoolExecutor(max_workers=PROCESSING_WORKERS)
+# atexit runs after the interpreter has joined the job threads above, so
+# running jobs finish before the summarizer's threads are stopped
+atexit.register(summarizer.close)
+
+ALLOWED_EXTENSIONS = frozenset({'pdf', 'png', 'jpg', 'jpeg'})
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB
 
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    """Return the lowercase extension if it is allowed, otherwise None"""
+    ext = os.path.splitext(filename)[1][1:].lower()
+    return ext if ext in ALLOWED_EXTENSIONS else None
+
+def copy_stream(src, out):
+    """Copy an upload stream into an open file in large chunks"""
+    # Werkzeug spools uploads in a SpooledTemporaryFile. Only once it has rolled
+    # over to a real temp file can it be copied in-kernel; calling fileno() on an
+    # in-memory spool would force that rollover and write the upload twice
+    if not getattr(src, '_rolled', False):
+        shutil.copyfileobj(src, out, length=UPLOAD_CHUNK_SIZE)
+        return
+    try:
+        src_fd = src.fileno()
+    except (AttributeError, io.UnsupportedOperation, OSError):
+        shutil.copyfileobj(src, out, length=UPLOAD_CHUNK_SIZE)
+        return
+    
+    offset = src.tell()
+    remaining = os.fstat(src_fd).st_size - offset
+    while remaining > 0:
+        sent = os.sendfile(out.fileno(), src_fd, offset, remaining)
+        if sent == 0:
+            break
+        offset += sent
+        remaining -= sent
+
+def save_upload(file, filepath):
+    """Stream an uploaded file to disk, only exposing it at filepath once complete"""
+    # Temp file in the same directory so the final rename is atomic
+    tmp = tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(filepath), prefix='.upload_',
+        suffix=os.path.splitext(filepath)[1], delete=False,
+        buffering=UPLOAD_CHUNK_SIZE
+    )
+    try:
+        with tmp:
+            copy_stream(file.stream, tmp)
+        os.replace(tmp.name, filepath)
+    except BaseException:
+        try:
+            os.unlink(tmp.name)
+        except FileNotFoundError:
+            pass
+        raise
+
+def drop_from_page_cache(filepath):
+    """Tell the kernel an archived upload will not be read again soon"""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(filepath, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+def recover_unfinished_jobs():
+    """
+    Fail prescriptions queued by a previous process so their pollers stop
+    Call once at server startup, before any uploads are accepted
+    """
+    stale_jobs = db.fail_unfinished_prescriptions()
+    if stale_jobs:
+        print(f"Marked {stale_jobs} unfinished prescription(s) from a previous run as failed")
+
+def process_prescription_job(prescription_id, filepath, patient_id, file_type):
+    """Run the summarizer for an uploaded prescription and record the outcome"""
+    try:
+        db.update_prescription_status(prescription_id, 'processing')
+        result = summarizer.process_prescription(
+            file_path=filepath,
+            patient_id=patient_id,
+            file_type=file_type
+        )
+        db.update_prescription_status(
+            prescription_id, 'completed',
+            diagnosis=result['extracted_data'].get('diagnosis'),
+            medications=json.dumps(result['extracted_data'].get('medications'),
+                                   separators=(',', ':'), ensure_ascii=False),
+            notes=result['extracted_data'].get('notes'),
+            doctor_summary=result['doctor_view'],
+            patient_summary=result['patient_view']
+        )
+        drop_from_page_cache(filepath)
+    except Exception as e:
+        print(f"Error processing prescription {prescription_id}: {e}")
+        db.update_prescription_status(prescription_id, 'failed')
+
+@app.before_request
+def load_user():
+    """Read the logged-in user from the session once per request"""
+    g.user = dict(session) if 'user_id' in session else None
 
 def login_required(user_type=None):
     """Decorator to check if user is logged in"""
     def decorator(f):
+        @wraps(f)
         def wrapper(*args, **kwargs):
-            if 'user_id' not in session:
+            if not g.user:
                 return jsonify({'error': 'Not authenticated'}), 401
-            if user_type and session.get('user_type') != user_type:
+            if user_type and g.user.get('user_type') != user_type:
                 return jsonify({'error': 'Unauthorized'}), 403
             return f(*args, **kwargs)
-        wrapper.__name__ = f.__name__
         return wrapper
     return decorator
 
+@app.errorhandler(RequestEntityTooLarge)
+def file_too_large(e):
+    """Reject uploads over MAX_CONTENT_LENGTH before they are read"""
+    return jsonify({'error': 'File too large (max 16MB)'}), 413
+
 # ==================== AUTHENTICATION ROUTES ====================
 
 @app.route('/')
@@ -101,12 +223,12 @@ def logout():
 @app.route('/api/session')
 def check_session():
     """Check if user is logged in"""
-    if 'user_id' in session:
+    if g.user:
         return jsonify({
             'logged_in': True,
-            'user_type': session.get('user_type'),
-            'user_id': session.get('user_id'),
-            'user_name': session.get('user_name')
+            'user_type': g.user.get('user_type'),
+            'user_id': g.user.get('user_id'),
+            'user_name': g.user.get('user_name')
         })
     return jsonify({'logged_in': False})
 
@@ -179,72 +301,103 @@ def upload_prescription():
         if file.filename == '':
             return jsonify({'error': 'No file selected'}), 400
         
-        if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            filename = f"{patient_id}_{timestamp}_{filename}"
+        file_type = allowed_file(file.filename)
+        if file and file_type:
+            # Nanosecond stamp + random suffix: unique even for concurrent uploads
+            stamp = f"{time.time_ns():x}"
+            short = uuid.uuid4().hex[:8]
+            safe_patient_id = patient_id.replace('/', '_').replace('\\', '_').replace('..', '_')
+            filename = f"{safe_patient_id}_{stamp}_{short}.{file_type}"
             filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
+            save_upload(file, filepath)
             
-            # Process prescription
-            file_type = filename.rsplit('.', 1)[1].lower()
-            result = summarizer.process_prescription(
-                file_path=filepath,
-                patient_id=patient_id,
-                file_type=file_type
-            )
-            
-            # Save prescription record to database
-            prescription_id = f"RX_{timestamp}_{patient_id}"
-            db.add_prescription_record(
+            # Save a pending prescription record, then process in the background
+            prescription_id = f"RX_{stamp}_{short}_{patient_id}"
+            if not db.add_prescription_record(
                 prescription_id=prescription_id,
                 patient_id=patient_id,
-                doctor_id=session.get('user_id'),
+                doctor_id=g.user['user_id'],
                 file_path=filepath,
                 file_type=file_type,
-                diagnosis=result['extracted_data'].get('diagnosis'),
-                medications=str(result['extracted_data'].get('medications')),
-                notes=result['extracted_data'].get('notes')
-            )
+                status='pending'
+            ):
+                return jsonify({'error': 'Duplicate upload, please retry'}), 409
+            
+            executor.submit(process_prescription_job, prescription_id,
+                            filepath, patient_id, file_type)
             
             return jsonify({
                 'success': True,
                 'prescription_id': prescription_id,
-                'doctor_summary': result['doctor_view'],
-                'patient_summary': result['patient_view'],
-                'extracted_data': result['extracted_data']
-            })
+                'status': 'pending',
+                'status_url': url_for('get_prescription_status',
+                                      prescription_id=prescription_id)
+            }), 202
         
         return jsonify({'error': 'Invalid file type'}), 400
     
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error processing prescription: {e}")
         return jsonify({'error': f'Processing failed: {str(e)}'}), 500
 
+@app.route('/api/prescription/<prescription_id>/status')
+@login_required()
+def get_prescription_status(prescription_id):
+    """Poll the processing status of an uploaded prescription"""
+    prescription = db.get_prescription(prescription_id)
+    if not prescription:
+        return jsonify({'error': 'Prescription not found'}), 404
+    
+    # Check authorization
+    if g.user['user_type'] == 'patient' and g.user['user_id'] != prescription['patient_id']:
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    response = {
+        'prescription_id': prescription_id,
+        'status': prescription['status']
+    }
+    
+    if prescription['status'] == 'completed':
+        # The summaries as this upload left them, even if later uploads moved on
+        response.update({
+            'doctor_summary': prescription['doctor_summary'],
+            'patient_summary': prescription['patient_summary'],
+            'extracted_data': {
+                'diagnosis': prescription['diagnosis'],
+                'medications': json.loads(prescription['medications'] or 'null'),
+                'notes': prescription['notes']
+            }
+        })
+    
+    return jsonify(response)
+
 @app.route('/api/history/<patient_id>')
 @login_required()
 def get_patient_history(patient_id):
     """Get patient's medical history"""
     # Check authorization
-    if session.get('user_type') == 'patient' and session.get('user_id') != patient_id:
+    if g.user['user_type'] == 'patient' and g.user['user_id'] != patient_id:
         return jsonify({'error': 'Unauthorized'}), 403
     
     # Get summary from ChromaDB
     existing_summary = summarizer.get_existing_summary(patient_id)
     
     if existing_summary:
-        # Get patient info
-        patient = db.get_patient(patient_id)
-        
-        # Get prescription records
-        prescriptions = db.get_patient_prescriptions(patient_id)
+        record = db.get_patient_with_prescriptions(patient_id)
         
-        return jsonify({
+        response = jsonify({
             'summary': existing_summary,
-            'patient': patient,
-            'prescriptions': prescriptions,
-            'total_prescriptions': len(prescriptions)
+            'patient': record['patient'],
+            'prescriptions': record['prescriptions'],
+            'total_prescriptions': record['total']
         })
+        
+        # Clients revalidate every time with If-None-Match and get a 304 when unchanged
+        response.set_etag(hashlib.blake2b(response.get_data(), digest_size=8).hexdigest())
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response.make_conditional(request)
     
     return jsonify({'message': 'No history found for this patient'}), 404
 
@@ -253,7 +406,7 @@ def get_patient_history(patient_id):
 def get_prescriptions(patient_id):
     """Get list of prescriptions for a patient"""
     # Check authorization
-    if session.get('user_type') == 'patient' and session.get('user_id') != patient_id:
+    if g.user['user_type'] == 'patient' and g.user['user_id'] != patient_id:
         return jsonify({'error': 'Unauthorized'}), 403
     
     prescriptions = db.get_patient_prescriptions(patient_id)
@@ -265,7 +418,7 @@ def get_prescriptions(patient_id):
 @login_required('doctor')
 def get_dashboard_stats():
     """Get dashboard statistics"""
-    doctor_id = session.get('user_id')
+    doctor_id = g.user['user_id']
     stats = db.get_dashboard_stats(doctor_id)
     return jsonify(stats)
 
@@ -298,19 +451,23 @@ def health_check():
     })
 
 if __name__ == '__main__':
-    # Create necessary directories
-    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    port = int(os.environ.get("PORT", 8080))
     
     print("=" * 60)
     print("🏥 MediSummarize - Patient Prescription System")
     print("=" * 60)
-    print(f"Server: http://localhost:5000")
+    print(f"Server: http://localhost:{port}")
     print(f"Gemini API: {'✅ Configured' if API_KEY else '❌ Not configured'}")
     print(f"Database: ✅ Initialized")
     print("\n📝 Demo Accounts:")
     print("   Doctor: doctor@demo.com / doctor123")
     print("   Patient: P001")
     print("=" * 60)
-    port = int(os.environ.get("PORT", 8080))
-    app.run(host="0.0.0.0", port=port)
-
+    
+    # Werkzeug's dev server is for local development only
+    if os.getenv("FLASK_DEV") == "1":
+        recover_unfinished_jobs()
+        app.run(host="0.0.0.0", port=port)
+    else:
+        print("Run with: gunicorn -c gunicorn.conf.py app:app")
+        print("(or set FLASK_DEV=1 to use the development server)")
@@ -3,21 +3,72 @@ SQLite Database Models for User Authentication & Patient Management
 Stores: Doctors, Patients, Prescriptions metadata
 """
 
+import os
+import ast
+import re
 import sqlite3
+import threading
 from datetime import datetime
 from typing import Optional, Dict, List
 import hashlib
+import hmac
 import json
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from cachetools import TTLCache
+
+# Legacy SHA-256 hash of the demo password; upgraded to argon2 on first login
+_DEMO_DOCTOR_HASH = hashlib.sha256(b"doctor123").hexdigest()
+
+_password_hasher = PasswordHasher()
+
+# Initialized once; copying a context is cheaper than creating a new one per call
+_SHA256_SEED = hashlib.sha256()
+
+# Looks like a patient ID (e.g. P001): try an exact lookup before searching
+_PATIENT_ID_RE = re.compile(r'[A-Z]\d{2,6}')
+
+_DEMO_DOCTORS = [
+    ("DOC001", " Rajesh Kumar", "doctor@demo.com", _DEMO_DOCTOR_HASH,
+     "General Medicine", "+91 9876543210"),
+]
+
+_DEMO_PATIENTS = [
+    ("P001", "Sachin sansare", 28, "Male", "+91 9876543211",
+     "sachin@demo.com", "Chennai, Tamil Nadu", "O+", None),
+]
 
 class Database:
     def __init__(self, db_path: str = "./medical_records.db"):
         self.db_path = db_path
+        self._local = threading.local()  # One connection per thread
+        
+        # Short-lived caches for lookups made on every authenticated request
+        self._cache_lock = threading.Lock()
+        self._patient_cache = TTLCache(maxsize=1024, ttl=60)
+        self._doctor_cache = TTLCache(maxsize=1024, ttl=60)
+        self._login_cache = TTLCache(maxsize=1024, ttl=60)
+        self._stats_cache = TTLCache(maxsize=256, ttl=30)
+        
         self.init_db()
     
     def get_connection(self):
-        """Get database connection"""
+        """Get this thread's database connection (opened lazily, kept open)"""
+        conn = getattr(self._local, 'conn', None)
+        # A connection inherited across fork() must not be reused by the child
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        
         conn = sqlite3.connect(self.db_path)
         conn.row_factory = sqlite3.Row  # Return rows as dictionaries
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-65536')  # 64MB page cache
+        conn.execute('PRAGMA mmap_size=268435456')  # 256MB memory map
+        
+        self._local.conn = conn
+        self._local.pid = os.getpid()
         return conn
     
     def init_db(self):
@@ -70,11 +121,23 @@ class Database:
                 diagnosis TEXT,
                 medications TEXT,
                 notes TEXT,
+                status TEXT NOT NULL DEFAULT 'completed',
+                doctor_summary TEXT,
+                patient_summary TEXT,
                 FOREIGN KEY (patient_id) REFERENCES patients(patient_id),
                 FOREIGN KEY (doctor_id) REFERENCES doctors(doctor_id)
             )
         ''')
         
+        # Columns added after the table was first shipped
+        cursor.execute('PRAGMA table_info(prescriptions)')
+        existing_columns = {col['name'] for col in cursor.fetchall()}
+        for column, definition in (("status", "TEXT NOT NULL DEFAULT 'completed'"),
+                                   ("doctor_summary", "TEXT"),
+                                   ("patient_summary", "TEXT")):
+            if column not in existing_columns:
+                cursor.execute(f'ALTER TABLE prescriptions ADD COLUMN {column} {definition}')
+        
         # Sessions table (for login tracking)
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS sessions (
@@ -86,51 +149,139 @@ class Database:
                 expires_at TIMESTAMP
             )
         ''')
+
+        # Full-text index over patient_id/name for search (trigram = infix matching)
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'patients_fts'")
+        fts_exists = cursor.fetchone() is not None
+
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS patients_fts USING fts5(
+                patient_id, name,
+                content='patients', content_rowid='id',
+                tokenize='trigram'
+            )
+        ''')
+
+        # Keep the FTS index in sync with the patients table
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS patients_fts_ai AFTER INSERT ON patients BEGIN
+                INSERT INTO patients_fts(rowid, patient_id, name)
+                VALUES (new.id, new.patient_id, new.name);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS patients_fts_ad AFTER DELETE ON patients BEGIN
+                INSERT INTO patients_fts(patients_fts, rowid, patient_id, name)
+                VALUES ('delete', old.id, old.patient_id, old.name);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS patients_fts_au AFTER UPDATE ON patients BEGIN
+                INSERT INTO patients_fts(patients_fts, rowid, patient_id, name)
+                VALUES ('delete', old.id, old.patient_id, old.name);
+                INSERT INTO patients_fts(rowid, patient_id, name)
+                VALUES (new.id, new.patient_id, new.name);
+            END
+        ''')
+
+        # Backfill existing patients the first time the index is created
+        if not fts_exists:
+            cursor.execute("INSERT INTO patients_fts(patients_fts) VALUES ('rebuild')")
+
+        # Indexes for the lookup, join and sort columns used below
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_patients_name ON patients(name)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_patients_created ON patients(created_at)')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_rx_patient_date
+            ON prescriptions(patient_id, upload_date DESC)
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_rx_doctor ON prescriptions(doctor_id)')
         
+        # Medications are stored as JSON; index the first medication name.
+        # Guarded by json_valid so writing plain-text medications cannot fail
+        self._migrate_medications_to_json(cursor)
+        cursor.execute('DROP INDEX IF EXISTS idx_rx_med_name')  # Unguarded earlier version
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_rx_first_med_name
+            ON prescriptions(CASE WHEN json_valid(medications)
+                                  THEN json_extract(medications, '$[0].name') END)
+        ''')
+
         conn.commit()
-        conn.close()
+
+        # Refresh planner statistics so the indexes above get picked
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")
+        if cursor.fetchone() is None:
+            cursor.execute('ANALYZE')
+        else:
+            cursor.execute('PRAGMA optimize')
+        conn.commit()
+        cursor.close()
         
         # Add default demo accounts
         self.create_demo_accounts()
     
+    def _migrate_medications_to_json(self, cursor):
+        """Convert medications saved as Python reprs into JSON text"""
+        cursor.execute('''
+            SELECT id, medications FROM prescriptions
+            WHERE medications IS NOT NULL AND NOT json_valid(medications)
+        ''')
+        for row in cursor.fetchall():
+            try:
+                value = ast.literal_eval(row['medications'])
+            except (ValueError, SyntaxError):
+                value = row['medications']  # Keep unparseable text as a JSON string
+            cursor.execute('UPDATE prescriptions SET medications = ? WHERE id = ?',
+                           (json.dumps(value, separators=(',', ':'), ensure_ascii=False),
+                            row['id']))
+    
     def hash_password(self, password: str) -> str:
-        """Hash password for security"""
-        return hashlib.sha256(password.encode()).hexdigest()
+        """Hash password for security (argon2id, salted)"""
+        return _password_hasher.hash(password)
+    
+    def _legacy_hash(self, password: str) -> str:
+        """Unsalted SHA-256 used by accounts created before argon2"""
+        h = _SHA256_SEED.copy()
+        h.update(password.encode())
+        return h.hexdigest()
+    
+    def _check_password(self, stored_hash: str, password: str) -> bool:
+        """Verify a password against an argon2 or legacy SHA-256 hash"""
+        if stored_hash.startswith('$argon2'):
+            try:
+                return _password_hasher.verify(stored_hash, password)
+            except (VerificationError, InvalidHashError):
+                return False
+        return hmac.compare_digest(stored_hash, self._legacy_hash(password))
     
     def create_demo_accounts(self):
         """Create demo doctor and patient accounts"""
-        # Use a separate connection with autocommit
-        conn = None
-        try:
-            conn = self.get_connection()
-            conn.isolation_level = None  # Autocommit mode
-            cursor = conn.cursor()
-            
-            # Demo Doctor
-            try:
-                cursor.execute('''
-                    INSERT OR IGNORE INTO doctors (doctor_id, name, email, password_hash, 
-                                       specialization, phone)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', ("DOC001", " Rajesh Kumar", "doctor@demo.com", 
-                      self.hash_password("doctor123"), "General Medicine", "+91 9876543210"))
-            except:
-                pass
-            
-            # Demo Patient
-            try:
-                cursor.execute('''
-                    INSERT OR IGNORE INTO patients (patient_id, name, age, gender, phone, 
-                                        email, address, blood_group, emergency_contact)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', ("P001", "Sachin sansare", 28, "Male", "+91 9876543211",
-                      "sachin@demo.com", "Chennai, Tamil Nadu", "O+", None))
-            except:
-                pass
-                
-        finally:
-            if conn:
-                conn.close()
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        # Already seeded: skip the writes (and their fsyncs) on every boot
+        cursor.execute('''
+            SELECT EXISTS (SELECT 1 FROM doctors WHERE doctor_id = 'DOC001')
+               AND EXISTS (SELECT 1 FROM patients WHERE patient_id = 'P001')
+        ''')
+        if cursor.fetchone()[0]:
+            cursor.close()
+            return
+        
+        # INSERT OR IGNORE leaves existing rows untouched, all in one transaction
+        with conn:
+            cursor.executemany('''
+                INSERT OR IGNORE INTO doctors (doctor_id, name, email, password_hash, 
+                                   specialization, phone)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', _DEMO_DOCTORS)
+            cursor.executemany('''
+                INSERT OR IGNORE INTO patients (patient_id, name, age, gender, phone, 
+                                    email, address, blood_group, emergency_contact)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', _DEMO_PATIENTS)
+        cursor.close()
     
     # ==================== DOCTOR METHODS ====================
     
@@ -138,54 +289,77 @@ class Database:
                    password: str, specialization: str = None, 
                    phone: str = None) -> bool:
         """Add new doctor"""
-        conn = None
+        conn = self.get_connection()
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                INSERT INTO doctors (doctor_id, name, email, password_hash, 
-                                   specialization, phone)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (doctor_id, name, email, self.hash_password(password), 
-                  specialization, phone))
-            
-            conn.commit()
+            with conn:
+                conn.execute('''
+                    INSERT INTO doctors (doctor_id, name, email, password_hash, 
+                                       specialization, phone)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (doctor_id, name, email, self.hash_password(password), 
+                      specialization, phone))
+            with self._cache_lock:
+                self._doctor_cache.pop(doctor_id, None)
             return True
         except sqlite3.IntegrityError:
             return False
-        finally:
-            if conn:
-                conn.close()
     
     def verify_doctor(self, email: str, password: str) -> Optional[Dict]:
         """Verify doctor login"""
+        # Keyed by a fast digest so repeat logins skip the argon2 check and
+        # a wrong password never matches a cached entry
+        key = (email, self._legacy_hash(password))
+        with self._cache_lock:
+            cached = self._login_cache.get(key)
+        if cached is not None:
+            return dict(cached)
+        
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            SELECT * FROM doctors 
-            WHERE email = ? AND password_hash = ?
-        ''', (email, self.hash_password(password)))
-        
+        cursor.execute('SELECT * FROM doctors WHERE email = ?', (email,))
         row = cursor.fetchone()
-        conn.close()
+        cursor.close()
         
-        if row:
-            return dict(row)
-        return None
+        if not row or not self._check_password(row['password_hash'], password):
+            return None
+        
+        doctor = dict(row)
+        
+        # Upgrade legacy or outdated hashes now that we know the password
+        stored_hash = doctor['password_hash']
+        if (not stored_hash.startswith('$argon2')
+                or _password_hasher.check_needs_rehash(stored_hash)):
+            doctor['password_hash'] = self.hash_password(password)
+            with conn:
+                conn.execute('UPDATE doctors SET password_hash = ? WHERE doctor_id = ?',
+                             (doctor['password_hash'], doctor['doctor_id']))
+            with self._cache_lock:
+                self._doctor_cache.pop(doctor['doctor_id'], None)
+        
+        with self._cache_lock:
+            self._login_cache[key] = doctor
+        return dict(doctor)
     
     def get_doctor(self, doctor_id: str) -> Optional[Dict]:
         """Get doctor information"""
+        with self._cache_lock:
+            cached = self._doctor_cache.get(doctor_id)
+        if cached is not None:
+            return dict(cached)
+        
         conn = self.get_connection()
         cursor = conn.cursor()
         
         cursor.execute('SELECT * FROM doctors WHERE doctor_id = ?', (doctor_id,))
         row = cursor.fetchone()
-        conn.close()
+        cursor.close()
         
         if row:
-            return dict(row)
+            doctor = dict(row)
+            with self._cache_lock:
+                self._doctor_cache[doctor_id] = doctor
+            return dict(doctor)
         return None
     
     # ==================== PATIENT METHODS ====================
@@ -195,44 +369,45 @@ class Database:
                    address: str = None, blood_group: str = None,
                    emergency_contact: str = None) -> bool:
         """Add new patient"""
-        conn = None
+        conn = self.get_connection()
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                INSERT INTO patients (patient_id, name, age, gender, phone, 
-                                    email, address, blood_group, emergency_contact)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (patient_id, name, age, gender, phone, email, address, 
-                  blood_group, emergency_contact))
-            
-            conn.commit()
+            with conn:
+                conn.execute('''
+                    INSERT INTO patients (patient_id, name, age, gender, phone, 
+                                        email, address, blood_group, emergency_contact)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (patient_id, name, age, gender, phone, email, address, 
+                      blood_group, emergency_contact))
+            with self._cache_lock:
+                self._patient_cache.pop(patient_id, None)
+                self._stats_cache.clear()
             return True
         except sqlite3.IntegrityError:
             return False
-        finally:
-            if conn:
-                conn.close()
     
     def get_patient(self, patient_id: str) -> Optional[Dict]:
         """Get patient information"""
+        with self._cache_lock:
+            cached = self._patient_cache.get(patient_id)
+        if cached is not None:
+            return dict(cached)  # Callers may mutate the result
+        
         conn = self.get_connection()
         cursor = conn.cursor()
         
         cursor.execute('SELECT * FROM patients WHERE patient_id = ?', (patient_id,))
         row = cursor.fetchone()
-        conn.close()
+        cursor.close()
         
         if row:
-            return dict(row)
+            patient = dict(row)
+            with self._cache_lock:
+                self._patient_cache[patient_id] = patient
+            return dict(patient)
         return None
     
     def update_patient(self, patient_id: str, **kwargs) -> bool:
         """Update patient information"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
         # Build dynamic update query
         fields = []
         values = []
@@ -247,24 +422,41 @@ class Database:
         values.append(patient_id)
         query = f"UPDATE patients SET {', '.join(fields)}, updated_at = CURRENT_TIMESTAMP WHERE patient_id = ?"
         
-        cursor.execute(query, values)
-        conn.commit()
-        conn.close()
+        conn = self.get_connection()
+        with conn:
+            conn.execute(query, values)
+        with self._cache_lock:
+            self._patient_cache.pop(patient_id, None)
         return True
     
     def search_patients(self, query: str) -> List[Dict]:
         """Search patients by name or ID"""
+        if _PATIENT_ID_RE.fullmatch(query):
+            patient = self.get_patient(query)
+            if patient:
+                return [patient]
+        
         conn = self.get_connection()
         cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT * FROM patients 
-            WHERE patient_id LIKE ? OR name LIKE ?
-            ORDER BY name
-        ''', (f'%{query}%', f'%{query}%'))
+
+        if len(query) >= 3:
+            # Trigram index matches substrings anywhere in patient_id or name
+            match = '"' + query.replace('"', '""') + '"'
+            cursor.execute('''
+                SELECT * FROM patients
+                WHERE id IN (SELECT rowid FROM patients_fts WHERE patients_fts MATCH ?)
+                ORDER BY name
+            ''', (match,))
+        else:
+            # Trigrams need at least 3 characters, fall back to a scan
+            cursor.execute('''
+                SELECT * FROM patients
+                WHERE patient_id LIKE ? OR name LIKE ?
+                ORDER BY name
+            ''', (f'%{query}%', f'%{query}%'))
         
         rows = cursor.fetchall()
-        conn.close()
+        cursor.close()
         
         return [dict(row) for row in rows]
     
@@ -277,33 +469,80 @@ class Database:
     def add_prescription_record(self, prescription_id: str, patient_id: str,
                                doctor_id: str, file_path: str, file_type: str,
                                diagnosis: str = None, medications: str = None,
-                               notes: str = None) -> bool:
+                               notes: str = None, status: str = 'completed') -> bool:
         """Add prescription record"""
+        conn = self.get_connection()
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                INSERT INTO prescriptions (prescription_id, patient_id, doctor_id,
-                                         file_path, file_type, diagnosis, 
-                                         medications, notes)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (prescription_id, patient_id, doctor_id, file_path, file_type,
-                  diagnosis, medications, notes))
-            
-            conn.commit()
-            conn.close()
+            with conn:
+                conn.execute('''
+                    INSERT INTO prescriptions (prescription_id, patient_id, doctor_id,
+                                             file_path, file_type, diagnosis, 
+                                             medications, notes, status)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (prescription_id, patient_id, doctor_id, file_path, file_type,
+                      diagnosis, medications, notes, status))
+            with self._cache_lock:
+                self._stats_cache.clear()
             return True
         except sqlite3.IntegrityError:
             return False
     
+    def update_prescription_status(self, prescription_id: str, status: str,
+                                   diagnosis: str = None, medications: str = None,
+                                   notes: str = None, doctor_summary: str = None,
+                                   patient_summary: str = None) -> bool:
+        """
+        Update processing status and, once processed, the extracted fields and
+        the summaries as they stood right after this prescription
+        """
+        conn = self.get_connection()
+        with conn:
+            cursor = conn.execute('''
+                UPDATE prescriptions
+                SET status = ?,
+                    diagnosis = COALESCE(?, diagnosis),
+                    medications = COALESCE(?, medications),
+                    notes = COALESCE(?, notes),
+                    doctor_summary = COALESCE(?, doctor_summary),
+                    patient_summary = COALESCE(?, patient_summary)
+                WHERE prescription_id = ?
+            ''', (status, diagnosis, medications, notes, doctor_summary,
+                  patient_summary, prescription_id))
+        return cursor.rowcount > 0
+    
+    def fail_unfinished_prescriptions(self) -> int:
+        """Mark prescriptions left pending/processing by a previous process as failed"""
+        conn = self.get_connection()
+        with conn:
+            cursor = conn.execute('''
+                UPDATE prescriptions SET status = 'failed'
+                WHERE status IN ('pending', 'processing')
+            ''')
+        return cursor.rowcount
+    
+    def get_prescription(self, prescription_id: str) -> Optional[Dict]:
+        """Get a single prescription record"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT * FROM prescriptions WHERE prescription_id = ?',
+                       (prescription_id,))
+        row = cursor.fetchone()
+        cursor.close()
+        
+        if row:
+            return dict(row)
+        return None
+    
     def get_patient_prescriptions(self, patient_id: str) -> List[Dict]:
         """Get all prescriptions for a patient"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
         cursor.execute('''
-            SELECT p.*, d.name as doctor_name 
+            SELECT p.id, p.prescription_id, p.patient_id, p.doctor_id,
+                   p.file_path, p.file_type, p.upload_date, p.diagnosis,
+                   p.medications, p.notes, p.status, d.name as doctor_name
             FROM prescriptions p
             LEFT JOIN doctors d ON p.doctor_id = d.doctor_id
             WHERE p.patient_id = ?
@@ -311,54 +550,68 @@ class Database:
         ''', (patient_id,))
         
         rows = cursor.fetchall()
-        conn.close()
+        cursor.close()
         
         return [dict(row) for row in rows]
     
+    def get_patient_with_prescriptions(self, patient_id: str) -> Dict:
+        """Get patient information and prescriptions on this thread's connection"""
+        patient = self.get_patient(patient_id)  # Usually a cache hit
+        prescriptions = self.get_patient_prescriptions(patient_id) if patient else []
+        return {
+            'patient': patient,
+            'prescriptions': prescriptions,
+            'total': len(prescriptions)
+        }
+    
     def get_prescription_count(self, patient_id: str) -> int:
         """Get count of prescriptions for a patient"""
         conn = self.get_connection()
         cursor = conn.cursor()
+        cursor.row_factory = None  # Plain tuples, no Row objects for a single int
         
         cursor.execute('''
-            SELECT COUNT(*) as count FROM prescriptions 
+            SELECT COUNT(*) FROM prescriptions 
             WHERE patient_id = ?
         ''', (patient_id,))
         
-        result = cursor.fetchone()
-        conn.close()
+        count = cursor.fetchone()[0]
+        cursor.close()
         
-        return result['count'] if result else 0
+        return count
     
     # ==================== STATS METHODS ====================
     
     def get_dashboard_stats(self, doctor_id: str = None) -> Dict:
         """Get dashboard statistics"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        stats = {}
+        with self._cache_lock:
+            cached = self._stats_cache.get(doctor_id)
+        if cached is not None:
+            return dict(cached)
         
-        # Total patients
-        cursor.execute('SELECT COUNT(*) as count FROM patients')
-        stats['total_patients'] = cursor.fetchone()['count']
+        # Filter on doctor_id only when given so idx_rx_doctor stays usable
+        rx_filter = 'WHERE doctor_id = ?' if doctor_id else ''
+        params = (doctor_id,) if doctor_id else ()
         
-        # Total prescriptions
-        if doctor_id:
-            cursor.execute('SELECT COUNT(*) as count FROM prescriptions WHERE doctor_id = ?', (doctor_id,))
-        else:
-            cursor.execute('SELECT COUNT(*) as count FROM prescriptions')
-        stats['total_prescriptions'] = cursor.fetchone()['count']
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.row_factory = None  # Plain (key, count) tuples
         
-        # Recent patients (last 7 days)
-        cursor.execute('''
-            SELECT COUNT(*) as count FROM patients 
+        # All three counts in a single round-trip
+        cursor.execute(f'''
+            SELECT 'total_patients', COUNT(*) FROM patients
+            UNION ALL
+            SELECT 'total_prescriptions', COUNT(*) FROM prescriptions {rx_filter}
+            UNION ALL
+            SELECT 'new_patients_week', COUNT(*) FROM patients
             WHERE created_at >= datetime('now', '-7 days')
-        ''')
-        stats['new_patients_week'] = cursor.fetchone()['count']
+        ''', params)
+        stats = {key: count for key, count in cursor.fetchall()}
+        cursor.close()
         
-        conn.close()
-        return stats
+        with self._cache_lock:
+            self._stats_cache[doctor_id] = stats
+        return dict(stats)
 
 
 # Example Usage
@@ -0,0 +1,29 @@
+"""
+Gunicorn configuration
+A single worker process: the embedded ChromaDB store, the summary caches and
+the background upload executor all live in-process, so concurrency comes
+from threads. Move ChromaDB to client/server mode before adding workers.
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+
+workers = 1
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+
+preload_app = False
+
+# Prescriptions are processed in the background, so requests themselves are short
+timeout = 120
+
+# Heartbeat files on tmpfs (better for Cloud Run)
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+
+def post_worker_init(worker):
+    """Fail the prescription jobs a previous (or crashed) worker left unfinished"""
+    from app import recover_unfinished_jobs
+    recover_unfinished_jobs()
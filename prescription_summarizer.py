@@ -6,101 +6,664 @@ FIXED: Separate doctor and patient view summaries with minimal metadata
 """
 
 import os
+import hashlib
+import itertools
+import re
+import tempfile
+import time
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 import json
+import logging
 import pickle
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from cachetools import TTLCache
 
 # Required packages:
-# pip install google-generativeai pillow pypdf2 chromadb sentence-transformers
+# pip install google-generativeai pypdf2 chromadb  (chromadb ships onnxruntime)
+# GPU embeddings (optional): pip install sentence-transformers torch
 
 import google.generativeai as genai
 from chromadb import PersistentClient
 from chromadb.config import Settings
 import chromadb.utils.embedding_functions as embedding_functions
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+import numpy as np
 import PyPDF2
-from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Summary instructions per role, shared by single-role and combined prompts
+DOCTOR_INSTRUCTIONS = """
+Generate with terminologies like 'This patient is' (in third person)
+
+Generate an UPDATED summary including:
+1. Patient Demographics
+2. Medical History Timeline (chronological, with dates)
+3. Current Active Medications (what they're taking NOW)
+4. Past Medications (discontinued or completed)
+5. Chronic Conditions
+6. Recent Symptoms/Complaints
+7. Test Results & Findings
+8. Treatment Response & Progress
+9. Clinical Notes & Observations
+
+Keep medical terminology. Be precise and clinical.
+Format clearly with sections using numbers for points.
+Merge with existing information intelligently - don't duplicate entries.
+If this is an update, show the progression/changes over time.
+Do not use # or markdown headers, use numbered points instead.
+"""
+
+PATIENT_INSTRUCTIONS = """
+Generate in first person speech like "You are..."
+
+Generate an UPDATED summary in simple language including:
+1. Your Basic Information
+2. Health History (what you've been treated for, with dates)
+3. Current Medications (what you're taking now and why)
+4. Past Treatments
+5. Health Conditions
+6. Recent Visits & Symptoms
+7. Test Results (in simple terms)
+8. Doctor's Advice & Next Steps
+
+Use simple, non-medical language. Explain medical terms in brackets.
+Be reassuring and clear. Format with sections using numbers for points.
+Merge with existing information intelligently - don't duplicate entries.
+If this is an update, explain what has changed in your treatment.
+Do not use # or markdown headers, use numbered points instead.
+"""
+
+# Per-role instructions for the combined call, which returns both views as JSON
+COMBINED_INSTRUCTIONS = f"""
+### DOCTOR_VIEW instructions
+{DOCTOR_INSTRUCTIONS}
+### PATIENT_VIEW instructions
+{PATIENT_INSTRUCTIONS}
+Return ONLY valid JSON with two string keys: "doctor_view" and "patient_view".
+Do not include any markdown formatting or code blocks.
+"""
+
+NO_DOCTOR_SUMMARY = "No previous summary available. This is the first prescription."
+NO_PATIENT_SUMMARY = "No previous summary available. This is your first prescription."
+
+# Per-call prompts; the role's static instructions are appended to them.
+# Gemini context caching is not used: each instruction block is a few hundred
+# tokens, well below the minimum cacheable size (1,024 tokens for 2.5 Flash)
+DOCTOR_PROMPT = """
+You are a medical assistant helping doctors. Create a comprehensive medical summary.
+
+Existing Summary (if any):
+{existing}
+
+New Prescription Data:
+{data}
+"""
+
+PATIENT_PROMPT = """
+You are a medical assistant helping patients understand their health record.
+
+Existing Summary (if any):
+{existing}
+
+New Prescription Data:
+{data}
+"""
+
+COMBINED_PROMPT = """
+You are a medical assistant. Update two separate summaries of the same patient's
+health record using the new prescription data: one for the doctor and one for the patient.
+
+New Prescription Data:
+{data}
+
+### DOCTOR_VIEW
+Existing Doctor Summary (if any):
+{existing_doctor}
+### PATIENT_VIEW
+Existing Patient Summary (if any):
+{existing_patient}
+"""
+
+def _compact_json(data: Dict) -> str:
+    """Prescription data as JSON without indentation or padding, to save prompt tokens"""
+    return json.dumps(data, separators=(',', ':'))
+
+# Structured output for prescription extraction; Gemini returns bare JSON in this shape
+_NULLABLE_STRING = {"type": "string", "nullable": True}
+EXTRACTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "patient_name": _NULLABLE_STRING,
+        "age": _NULLABLE_STRING,
+        "date": _NULLABLE_STRING,
+        "complaints": _NULLABLE_STRING,
+        "diagnosis": _NULLABLE_STRING,
+        "medications": {
+            "type": "array",
+            "nullable": True,
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string"},
+                    "dosage": _NULLABLE_STRING,
+                    "frequency": _NULLABLE_STRING,
+                    "duration": _NULLABLE_STRING
+                }
+            }
+        },
+        "tests": {"type": "array", "nullable": True, "items": {"type": "string"}},
+        "notes": _NULLABLE_STRING
+    }
+}
+EXTRACTION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": EXTRACTION_SCHEMA
+}
+
+# Markdown code fences Gemini may still wrap JSON in, stripped in one pass
+_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$", re.MULTILINE)
+
+GEMINI_MODEL = 'gemini-2.5-flash'
+
+# Target size of each existing summary fed back into a prompt, so input size
+# stays flat as a patient's history grows. Gemini rewrites the stored summary
+# from this input, so only the history-style sections are ever trimmed
+MAX_CONTEXT_CHARS = 4000
+
+# Sections always kept whole: demographics/basic information (1), current and
+# past medications or treatments (3, 4) and chronic/health conditions (5)
+PROTECTED_SECTIONS = frozenset({1, 3, 4, 5})
+
+# First word of each numbered section title, from both roles' instructions,
+# used to tell section headings from numbered points inside a section
+_SECTION_FIRST_WORDS = {}
+for _instructions in (DOCTOR_INSTRUCTIONS, PATIENT_INSTRUCTIONS):
+    for _number, _word in re.findall(r"^(\d+)\. (\w+)", _instructions, re.MULTILINE):
+        _SECTION_FIRST_WORDS.setdefault(int(_number), set()).add(_word.lower())
+_HEADING_RE = re.compile(r"^[\s*#]*(\d{1,2})[.)][\s*]*(\w+)")
+# Placeholder _trim_section leaves in the prompt, which the model may echo back
+_OMITTED_MARKER_RE = re.compile(r"^\s*\[\.\.\.\d+ earlier entries omitted\]\s*$")
+
+# Image uploads are sent to Gemini as-is, tagged with their MIME type
+IMAGE_MIME_TYPES = {"jpg": "image/jpeg", "jpeg": "image/jpeg", "png": "image/png"}
+
+# Embedding functions that all produce all-MiniLM-L6-v2 vectors. A collection
+# stored under one of them can be re-tagged to another without re-embedding
+MINILM_EMBEDDING_FUNCTIONS = frozenset({"sentence_transformer", "default", "onnx_mini_lm_l6_v2",
+                                        "cuda_mini_lm_l6_v2_fp16"})
+MINILM_MODEL_NAME = "all-MiniLM-L6-v2"
+
+@embedding_functions.register_embedding_function
+class CudaMiniLMEmbeddingFunction(EmbeddingFunction[Documents]):
+    """all-MiniLM-L6-v2 in fp16 on the GPU, encoding large length-sorted batches"""
+    
+    def __init__(self, batch_size: int = 256):
+        self.batch_size = batch_size
+        self._model = None
+        self._pid = None
+        self._lock = threading.Lock()
+    
+    def _get_model(self):
+        # CUDA state does not survive fork(), so each process loads its own copy
+        if self._model is None or self._pid != os.getpid():
+            with self._lock:
+                if self._model is None or self._pid != os.getpid():
+                    from sentence_transformers import SentenceTransformer
+                    self._model = SentenceTransformer(MINILM_MODEL_NAME, device="cuda").half()
+                    self._pid = os.getpid()
+        return self._model
+    
+    def __call__(self, input: Documents) -> Embeddings:
+        # Batches of similar length keep padding, and wasted GPU work, small
+        order = sorted(range(len(input)), key=lambda i: len(input[i]), reverse=True)
+        vectors = self._get_model().encode(
+            [input[i] for i in order],
+            batch_size=self.batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True
+        )
+        embeddings = [None] * len(input)
+        for position, index in enumerate(order):
+            embeddings[index] = np.asarray(vectors[position], dtype=np.float32)
+        return embeddings
+    
+    @staticmethod
+    def name() -> str:
+        return "cuda_mini_lm_l6_v2_fp16"
+    
+    def get_config(self) -> Dict:
+        return {"model_name": MINILM_MODEL_NAME, "precision": "fp16",
+                "batch_size": self.batch_size}
+    
+    @staticmethod
+    def build_from_config(config: Dict) -> "CudaMiniLMEmbeddingFunction":
+        return CudaMiniLMEmbeddingFunction(batch_size=config.get("batch_size", 256))
+
+def _cuda_available() -> bool:
+    """True when PyTorch can use a GPU, checked without creating a CUDA context"""
+    # No NVIDIA driver means no GPU; skip importing torch altogether
+    if not os.path.exists("/proc/driver/nvidia/version"):
+        return False
+    # NVML-based check keeps the preloading parent process fork-safe
+    os.environ.setdefault("PYTORCH_NVML_BASED_CUDA_CHECK", "1")
+    try:
+        import torch
+    except ImportError:
+        return False
+    return torch.cuda.is_available()
+
+# Heavy resources shared by every summarizer in the process. genai.configure is
+# process-global, so the API key is too; ChromaDB clients are kept per db_path.
+# All are created lazily so that preloaded web workers build their own after fork()
+_shared_lock = threading.Lock()
+_embedding_function = None
+_gemini_model = None
+_chroma_clients = {}
+
+def _get_embedding_function():
+    """Embedding function shared by all summarizers, loaded once"""
+    global _embedding_function
+    if _embedding_function is None:
+        with _shared_lock:
+            if _embedding_function is None:
+                if _cuda_available():
+                    _embedding_function = CudaMiniLMEmbeddingFunction()
+                else:
+                    embedding_function = embedding_functions.ONNXMiniLM_L6_V2()
+                    # The ONNX model is downloaded and its session built on first
+                    # call; do it once here rather than inside the first request
+                    try:
+                        embedding_function([""])
+                    except Exception as e:
+                        print(f"Embedding model warm-up failed, will retry on first use: {e}")
+                    _embedding_function = embedding_function
+    return _embedding_function
+
+def _get_model():
+    """Gemini model shared by all summarizers, created on first use"""
+    global _gemini_model
+    if _gemini_model is None:
+        with _shared_lock:
+            if _gemini_model is None:
+                _gemini_model = genai.GenerativeModel(GEMINI_MODEL)
+    return _gemini_model
+
+def _get_chroma_client(db_path: str):
+    """ChromaDB client for db_path, opened once per process"""
+    key = os.path.abspath(db_path)
+    client = _chroma_clients.get(key)
+    if client is None:
+        with _shared_lock:
+            client = _chroma_clients.get(key)
+            if client is None:
+                client = PersistentClient(
+                    path=db_path,
+                    settings=Settings(
+                        anonymized_telemetry=False
+                    )
+                )
+                _chroma_clients[key] = client
+    return client
+
+def _copy_collection(client, source, name: str, embedding_function):
+    """Copy source into collection name under embedding_function, then drop source"""
+    target = client.get_or_create_collection(
+        name=name,
+        metadata=source.metadata,
+        embedding_function=embedding_function
+    )
+    page_size = client.get_max_batch_size()
+    offset = 0
+    while True:
+        page = source.get(include=["documents", "metadatas", "embeddings"],
+                          limit=page_size, offset=offset)
+        if not page["ids"]:
+            break
+        # Stored vectors come from the same model, so they are copied as they are
+        target.upsert(
+            ids=page["ids"],
+            embeddings=page["embeddings"],
+            documents=page["documents"],
+            metadatas=page["metadatas"]
+        )
+        offset += len(page["ids"])
+    client.delete_collection(source.name)
+    return target
+
+def _open_collection(client, name: str, embedding_function):
+    """
+    Get or create a collection for embedding_function, re-tagging one stored
+    under another MiniLM embedding function instead of failing on the conflict
+    """
+    retag_name = f"{name}_retag"
+    collection_names = {c.name for c in client.list_collections()}
+    
+    if retag_name in collection_names:
+        # An earlier re-tag stopped part way; the renamed source is still complete
+        return _copy_collection(client, client.get_collection(name=retag_name),
+                                name, embedding_function)
+    if name not in collection_names:
+        return client.create_collection(name=name, embedding_function=embedding_function)
+    
+    try:
+        return client.get_collection(name=name, embedding_function=embedding_function)
+    except ValueError:
+        # Opened without an embedding function, Chroma skips the conflict check
+        existing = client.get_collection(name=name)
+        persisted = existing.configuration_json.get("embedding_function") or {}
+        model_name = (persisted.get("config") or {}).get("model_name", MINILM_MODEL_NAME)
+        if (persisted.get("name") not in MINILM_EMBEDDING_FUNCTIONS
+                or not model_name.endswith(MINILM_MODEL_NAME)):
+            raise
+    
+    # Chroma cannot change a collection's embedding function in place, so the
+    # collection is moved aside and copied back under the new one
+    print(f"Re-tagging ChromaDB collection {name}: "
+          f"{persisted.get('name')} -> {embedding_function.name()}")
+    existing.modify(name=retag_name)
+    return _copy_collection(client, existing, name, embedding_function)
+
+def _split_sections(summary: str):
+    """Split a summary into its preamble lines and numbered (section, lines) pairs"""
+    preamble, sections = [], []
+    for line in summary.splitlines():
+        match = _HEADING_RE.match(line)
+        if match:
+            number = int(match.group(1))
+            # Headings come in order and carry the instructed title
+            if (number == len(sections) + 1
+                    and match.group(2).lower() in _SECTION_FIRST_WORDS.get(number, ())):
+                sections.append((number, [line]))
+                continue
+        if sections:
+            sections[-1][1].append(line)
+        else:
+            preamble.append(line)
+    return preamble, sections
+
+def _trim_section(lines: List[str], budget: int) -> Tuple[List[str], List[str]]:
+    """
+    A section's heading plus as many of its most recent lines as fit in budget,
+    and the earlier lines left out
+    """
+    heading, body = lines[0], lines[1:]
+    kept, used = [], len(heading) + 1
+    for line in reversed(body):
+        if used + len(line) + 1 > budget:
+            break
+        kept.append(line)
+        used += len(line) + 1
+    kept.reverse()
+    
+    left_out = body[:len(body) - len(kept)]
+    omitted = sum(1 for line in left_out if line.strip())
+    if not omitted:
+        return lines, []
+    return [heading, f"[...{omitted} earlier entries omitted]"] + kept, left_out
+
+def _truncate_context(summary: Optional[str], max_chars: int = MAX_CONTEXT_CHARS
+                      ) -> Tuple[Optional[str], Dict[int, Tuple[str, List[str]]]]:
+    """
+    Shorten a long summary section by section, keeping PROTECTED_SECTIONS whole
+    and the most recent lines of the others; unstructured text is left as is
+    Also returns the (heading, lines) left out of each trimmed section, for
+    _restore_omitted to put back into the summary generated from it
+    """
+    if summary is None or len(summary) <= max_chars:
+        return summary, {}
+    
+    preamble, sections = _split_sections(summary)
+    if len(sections) < max(PROTECTED_SECTIONS):
+        # Not in the instructed layout; cutting blindly could drop medications
+        return summary, {}
+    
+    def size(lines):
+        return sum(len(line) + 1 for line in lines)
+    
+    budget = max_chars - size(preamble) - sum(
+        size(lines) for number, lines in sections if number in PROTECTED_SECTIONS)
+    
+    # Share the remaining budget out, smallest sections first so any space
+    # they leave unused goes to the larger ones
+    trimmable = sorted((i for i, (number, _) in enumerate(sections)
+                        if number not in PROTECTED_SECTIONS),
+                       key=lambda i: size(sections[i][1]))
+    trimmed, omitted = {}, {}
+    for position, i in enumerate(trimmable):
+        share = max(budget, 0) // (len(trimmable) - position)
+        number, section_lines = sections[i]
+        trimmed[i], left_out = _trim_section(section_lines, share)
+        if left_out:
+            omitted[number] = (section_lines[0], left_out)
+        budget -= size(trimmed[i])
+    
+    lines = list(preamble)
+    for i, (_, section_lines) in enumerate(sections):
+        lines.extend(trimmed.get(i, section_lines))
+    return "\n".join(lines), omitted
+
+def _restore_omitted(summary: str, omitted: Dict[int, Tuple[str, List[str]]]) -> str:
+    """
+    Put the lines _truncate_context left out of the prompt back into the
+    summary generated from it, so trimming the input never erases history
+    Lines go back at the top of their section, being its earliest entries;
+    sections the new summary lacks are appended whole at the end
+    """
+    if not omitted:
+        return summary
+    
+    preamble, sections = _split_sections(summary)
+    remaining = dict(omitted)
+    lines = [line for line in preamble if not _OMITTED_MARKER_RE.match(line)]
+    for number, section_lines in sections:
+        lines.append(section_lines[0])
+        lines.extend(remaining.pop(number, (None, []))[1])
+        lines.extend(line for line in section_lines[1:]
+                     if not _OMITTED_MARKER_RE.match(line))
+    
+    for number in sorted(remaining):
+        heading, earlier = remaining[number]
+        lines.append("")
+        lines.append(heading)
+        lines.extend(earlier)
+    return "\n".join(lines)
 
 class PrescriptionSummarizer:
-    def __init__(self, api_key: str, db_path: str = "./patient_db"):
-        """Initialize the summarizer with Gemini API key and database path"""
+    def __init__(self, api_key: str, db_path: str = "./patient_db",
+                 concurrent_jobs: int = 1):
+        """
+        Initialize the summarizer with Gemini API key and database path
+        concurrent_jobs is how many prescriptions the caller processes at once
+        The embedding model, Gemini model and ChromaDB client are shared
+        process-wide, so extra instances are cheap
+        """
         self.api_key = api_key
         self.db_path = db_path
         
         # Configure Gemini
         genai.configure(api_key=api_key)
         
-        # Initialize Gemini model
-        self.model = genai.GenerativeModel('gemini-2.5-flash')
+        # MiniLM embeddings: fp16 on a GPU when present, otherwise onnxruntime on CPU
+        # Bound eagerly so the model is loaded at startup, not on the first upload
+        self.embedding_function = _get_embedding_function()
         
-        # Initialize ChromaDB with sentence-transformers for embeddings
-        self.chroma_client = PersistentClient(
-            path=db_path,
-            settings=Settings(
-                anonymized_telemetry=False
-            )
-        )
+        # ChromaDB holds connections/threads that do not survive fork(), so
+        # collections are opened lazily on first use in each worker
+        self._chroma_client = None
+        self._doctor_collection = None
+        self._patient_collection = None
+        self._init_lock = threading.Lock()
         
-        # Use sentence-transformers for embeddings (free, local)
-        self.embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(
-            model_name="all-MiniLM-L6-v2"
-        )
+        # Long-lived threads for retrieval and storage: each keeps its own
+        # metadata connection instead of opening one per prescription.
+        # Every job runs its doctor and patient tasks side by side
+        self._executor = ThreadPoolExecutor(max_workers=2 * max(concurrent_jobs, 1),
+                                            thread_name_prefix="summarizer")
         
-        # Create separate collections for doctor and patient views
-        collection_names = [c.name for c in self.chroma_client.list_collections()]
+        # Sequence number that keeps document ids unique within a nanosecond
+        self._id_counter = itertools.count()
+        self._id_lock = threading.Lock()
         
-        if "doctor_summaries" in collection_names:
-            self.doctor_collection = self.chroma_client.get_collection(
-                name="doctor_summaries",
-                embedding_function=self.embedding_function
-            )
-        else:
-            self.doctor_collection = self.chroma_client.create_collection(
-                name="doctor_summaries",
-                embedding_function=self.embedding_function
-            )
+        # Recently retrieved summaries, keyed by (patient_id, role)
+        self._summary_cache = TTLCache(maxsize=1024, ttl=30)
+        self._summary_cache_lock = threading.Lock()
+        
+        # Latest summary per (patient, role) in SQLite, one row written per update
+        self._local = threading.local()  # One connection per thread
+        self.metadata_file = os.path.join(db_path, "patient_metadata.db")
+        self._init_metadata()
         
-        if "patient_summaries" in collection_names:
-            self.patient_collection = self.chroma_client.get_collection(
-                name="patient_summaries",
-                embedding_function=self.embedding_function
+        # Structured extraction results keyed by file content hash
+        self.extract_cache_dir = os.path.join(db_path, "extract_cache")
+    
+    def close(self):
+        """Wait for queued retrieval and storage tasks, then stop the worker threads"""
+        self._executor.shutdown(wait=True)
+    
+    @property
+    def model(self):
+        """Gemini model, created on first use"""
+        return _get_model()
+    
+    @property
+    def doctor_collection(self):
+        """ChromaDB collection holding doctor-view summaries"""
+        if self._doctor_collection is None:
+            self._init_collections()
+        return self._doctor_collection
+    
+    @property
+    def patient_collection(self):
+        """ChromaDB collection holding patient-view summaries"""
+        if self._patient_collection is None:
+            self._init_collections()
+        return self._patient_collection
+    
+    def _init_collections(self):
+        """Open ChromaDB and create separate collections for doctor and patient views"""
+        with self._init_lock:
+            if self._doctor_collection is not None:
+                return
+            
+            self._chroma_client = _get_chroma_client(self.db_path)
+            
+            self._patient_collection = _open_collection(
+                self._chroma_client, "patient_summaries", self.embedding_function
             )
-        else:
-            self.patient_collection = self.chroma_client.create_collection(
-                name="patient_summaries",
-                embedding_function=self.embedding_function
+            
+            # Assigned last: other threads treat a non-None doctor collection as "ready"
+            self._doctor_collection = _open_collection(
+                self._chroma_client, "doctor_summaries", self.embedding_function
             )
+    
+    def _get_metadata_connection(self):
+        """Get this thread's connection to the metadata store"""
+        conn = getattr(self._local, 'conn', None)
+        # A connection inherited across fork() must not be reused by the child
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
         
-        # Create metadata storage
-        self.metadata_file = os.path.join(db_path, "patient_metadata.pkl")
-        self.metadata = self._load_metadata()
+        os.makedirs(self.db_path, exist_ok=True)
+        conn = sqlite3.connect(self.metadata_file)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
     
-    def _load_metadata(self) -> Dict:
-        """Load patient metadata from file"""
-        if os.path.exists(self.metadata_file):
-            with open(self.metadata_file, 'rb') as f:
-                return pickle.load(f)
-        return {}
+    def _init_metadata(self):
+        """Create the metadata table and import the legacy pickle once"""
+        conn = self._get_metadata_connection()
+        with conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS patient_meta (
+                    patient_id TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    summary TEXT,
+                    prescription TEXT,
+                    updated TEXT,
+                    PRIMARY KEY (patient_id, role)
+                )
+            ''')
+        
+        legacy_file = os.path.join(self.db_path, "patient_metadata.pkl")
+        if not os.path.exists(legacy_file):
+            return
+        if conn.execute('SELECT 1 FROM patient_meta LIMIT 1').fetchone():
+            return
+        
+        with open(legacy_file, 'rb') as f:
+            legacy = pickle.load(f)
+        
+        rows = []
+        for patient_id, entry in legacy.items():
+            for role in ("doctor", "patient"):
+                summary = entry.get(f'latest_summary_{role}')
+                if summary is not None:
+                    rows.append((patient_id, role, summary,
+                                 json.dumps(entry.get(f'latest_prescription_{role}'),
+                                            ensure_ascii=False, default=str),
+                                 entry.get('last_updated')))
+        with conn:
+            conn.executemany('''
+                INSERT OR REPLACE INTO patient_meta
+                    (patient_id, role, summary, prescription, updated)
+                VALUES (?, ?, ?, ?, ?)
+            ''', rows)
     
-    def _save_metadata(self):
-        """Save patient metadata to file"""
-        os.makedirs(self.db_path, exist_ok=True)
-        with open(self.metadata_file, 'wb') as f:
-            pickle.dump(self.metadata, f)
+    def _load_summary_metadata(self, patient_id: str, role: str) -> Optional[str]:
+        """Get the latest stored summary for a patient and role"""
+        row = self._get_metadata_connection().execute(
+            'SELECT summary FROM patient_meta WHERE patient_id = ? AND role = ?',
+            (patient_id, role)
+        ).fetchone()
+        return row[0] if row else None
+    
+    def _save_summary_metadata(self, patient_id: str, summaries: Dict[str, str],
+                               new_prescription: Dict, updated: Optional[str] = None):
+        """Write the latest summary for each given role in one transaction"""
+        prescription = json.dumps(new_prescription, ensure_ascii=False, default=str)
+        updated = updated or datetime.now().isoformat()
+        conn = self._get_metadata_connection()
+        with conn:
+            conn.executemany('''
+                INSERT OR REPLACE INTO patient_meta
+                    (patient_id, role, summary, prescription, updated)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(patient_id, role, summary, prescription, updated)
+                  for role, summary in summaries.items()])
+    
+    @staticmethod
+    def _parse_gemini_json(text: str) -> dict:
+        """Parse JSON from a Gemini response, tolerating markdown code fences"""
+        return json.loads(_FENCE_RE.sub("", text.strip()))
     
     def extract_text_from_pdf(self, pdf_path: str) -> str:
         """Extract text from PDF prescription"""
-        text = ""
-        with open(pdf_path, 'rb') as file:
+        parts = []
+        with open(pdf_path, 'rb', buffering=1 << 16) as file:
             pdf_reader = PyPDF2.PdfReader(file)
             for page in pdf_reader.pages:
-                text += page.extract_text()
-        return text
+                # extract_text() can return None for empty pages
+                parts.append(page.extract_text() or "")
+        if not parts:
+            return ""
+        return "".join(parts)
     
     def process_image_directly(self, image_path: str) -> Dict:
         """Use Gemini's vision to read prescription image directly (NO OCR NEEDED!)"""
-        img = Image.open(image_path)
+        extension = os.path.splitext(image_path)[1].lstrip(".").lower()
+        with open(image_path, 'rb') as file:
+            image_part = {
+                "mime_type": IMAGE_MIME_TYPES.get(extension, "image/jpeg"),
+                "data": file.read()
+            }
         
         prompt = """
         Analyze this prescription image and extract the following information:
@@ -118,22 +681,12 @@ class PrescriptionSummarizer:
         Be thorough and extract all visible information.
         """
         
-        response = self.model.generate_content([prompt, img])
+        response = self.model.generate_content([prompt, image_part],
+                                               generation_config=EXTRACTION_CONFIG)
         
         try:
-            # Clean response text
-            text = response.text.strip()
-            # Remove markdown code blocks if present
-            if text.startswith('```json'):
-                text = text[7:]
-            if text.startswith('```'):
-                text = text[3:]
-            if text.endswith('```'):
-                text = text[:-3]
-            text = text.strip()
-            
-            return json.loads(text)
-        except Exception as e:
+            return self._parse_gemini_json(response.text)
+        except json.JSONDecodeError as e:
             print(f"Error parsing JSON: {e}")
             print(f"Raw response: {response.text}")
             return {"raw_text": response.text, "error": "Could not parse structured data"}
@@ -159,169 +712,246 @@ class PrescriptionSummarizer:
         Do not include any markdown formatting or code blocks.
         """
         
-        response = self.model.generate_content(prompt)
+        response = self.model.generate_content(prompt, generation_config=EXTRACTION_CONFIG)
         
         try:
-            text = response.text.strip()
-            # Remove markdown code blocks if present
-            if text.startswith('```json'):
-                text = text[7:]
-            if text.startswith('```'):
-                text = text[3:]
-            if text.endswith('```'):
-                text = text[:-3]
-            text = text.strip()
-            
-            return json.loads(text)
-        except Exception as e:
+            return self._parse_gemini_json(response.text)
+        except json.JSONDecodeError as e:
             print(f"Error parsing JSON: {e}")
             print(f"Raw response: {response.text}")
             return {"raw_text": response.text, "error": "Could not parse structured data"}
     
+    def _extraction_cache_file(self, file_path: str) -> str:
+        """Cache file for a prescription, named by a hash of its contents"""
+        digest = hashlib.blake2b(digest_size=16)
+        with open(file_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+        return os.path.join(self.extract_cache_dir, f"{digest.hexdigest()}.json")
+    
+    def _load_cached_extraction(self, cache_file: str) -> Optional[Dict]:
+        """Return a previously extracted result for identical file contents"""
+        try:
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable extraction cache {cache_file}: {e}")
+            return None
+    
+    def _save_cached_extraction(self, cache_file: str, prescription_data: Dict):
+        """Write an extraction result, only exposing it once complete"""
+        os.makedirs(self.extract_cache_dir, exist_ok=True)
+        # Temp file in the same directory so the final rename is atomic
+        tmp = tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=self.extract_cache_dir,
+                                          prefix='.extract_', suffix='.json', delete=False)
+        try:
+            with tmp:
+                json.dump(prescription_data, tmp, ensure_ascii=False, default=str)
+            os.replace(tmp.name, cache_file)
+        except OSError as e:
+            print(f"Could not write extraction cache {cache_file}: {e}")
+            try:
+                os.unlink(tmp.name)
+            except FileNotFoundError:
+                pass
+    
     def get_existing_summary(self, patient_id: str, role: str = "doctor") -> Optional[str]:
         """
         RETRIEVAL STEP (R in RAG)
         Retrieve existing patient summary from ChromaDB vector store BY ROLE
         """
+        key = (patient_id, role)
+        with self._summary_cache_lock:
+            cached = self._summary_cache.get(key)
+        if cached is not None:
+            return cached
+        
+        summary = self._query_summary(patient_id, role)
+        if summary is not None:
+            with self._summary_cache_lock:
+                self._summary_cache[key] = summary
+        return summary
+    
+    def _query_summary(self, patient_id: str, role: str) -> Optional[str]:
+        """Look up the latest stored summary: metadata first, then ChromaDB"""
+        # Point lookup on (patient_id, role); no embedding or similarity search needed
+        summary = self._load_summary_metadata(patient_id, role)
+        if summary is not None:
+            return summary
+        
         # Select the correct collection based on role
         collection = self.doctor_collection if role == "doctor" else self.patient_collection
         
         try:
-            results = collection.query(
-                query_texts=[f"patient_id:{patient_id} {role} summary"],
-                n_results=1,
-                where={"patient_id": patient_id}
+            results = collection.get(
+                where={"$and": [{"patient_id": patient_id}, {"role": role}]},
+                include=["documents", "metadatas"]
             )
             
-            if results['documents'] and len(results['documents'][0]) > 0:
-                return results['documents'][0][0]
+            if results['documents']:
+                # Latest by ISO timestamp
+                latest = max(range(len(results['documents'])),
+                             key=lambda i: results['metadatas'][i].get("timestamp", ""))
+                return results['documents'][latest]
         except Exception as e:
             print(f"ChromaDB query error: {e}")
         
-        # Fallback to metadata with role-specific key
-        if patient_id in self.metadata:
-            return self.metadata[patient_id].get(f'latest_summary_{role}')
-        
         return None
     
     def generate_summary(self, new_prescription: Dict, existing_summary: Optional[str], 
-                        patient_id: str, role: str = "doctor") -> str:
+                        patient_id: str, role: str = "doctor",
+                        batch: Optional[Dict[str, list]] = None) -> str:
         """
         AUGMENTED GENERATION STEP (AG in RAG)
         Generate or update patient summary based on role (doctor/patient)
         Combines OLD summary + NEW prescription data
         """
+        existing_summary, omitted = _truncate_context(existing_summary)
         
         if role == "doctor":
-            prompt = f"""
-            You are a medical assistant helping doctors. Create a comprehensive medical summary.
-            Generate with terminologies like 'This patient is' (in third person)
-            
-            Existing Summary (if any):
-            {existing_summary or "No previous summary available. This is the first prescription."}
-            
-            New Prescription Data:
-            {json.dumps(new_prescription, indent=2)}
-            
-            Generate an UPDATED summary including:
-            1. Patient Demographics
-            2. Medical History Timeline (chronological, with dates)
-            3. Current Active Medications (what they're taking NOW)
-            4. Past Medications (discontinued or completed)
-            5. Chronic Conditions
-            6. Recent Symptoms/Complaints
-            7. Test Results & Findings
-            8. Treatment Response & Progress
-            9. Clinical Notes & Observations
-            
-            Keep medical terminology. Be precise and clinical.
-            Format clearly with sections using numbers for points.
-            Merge with existing information intelligently - don't duplicate entries.
-            If this is an update, show the progression/changes over time.
-            Do not use # or markdown headers, use numbered points instead.
-            """
+            template, instructions, no_summary = DOCTOR_PROMPT, DOCTOR_INSTRUCTIONS, NO_DOCTOR_SUMMARY
         else:  # patient view
-            prompt = f"""
-            You are a medical assistant helping patients understand their health record.
-            Generate in first person speech like "You are..."
-            
-            Existing Summary (if any):
-            {existing_summary or "No previous summary available. This is your first prescription."}
-            
-            New Prescription Data:
-            {json.dumps(new_prescription, indent=2)}
-            
-            Generate an UPDATED summary in simple language including:
-            1. Your Basic Information
-            2. Health History (what you've been treated for, with dates)
-            3. Current Medications (what you're taking now and why)
-            4. Past Treatments
-            5. Health Conditions
-            6. Recent Visits & Symptoms
-            7. Test Results (in simple terms)
-            8. Doctor's Advice & Next Steps
-            
-            Use simple, non-medical language. Explain medical terms in brackets.
-            Be reassuring and clear. Format with sections using numbers for points.
-            Merge with existing information intelligently - don't duplicate entries.
-            If this is an update, explain what has changed in your treatment.
-            Do not use # or markdown headers, use numbered points instead.
-            """
+            template, instructions, no_summary = PATIENT_PROMPT, PATIENT_INSTRUCTIONS, NO_PATIENT_SUMMARY
+        
+        prompt = template.format_map({
+            "existing": existing_summary or no_summary,
+            "data": _compact_json(new_prescription)
+        })
+        
+        response = self.model.generate_content(prompt + instructions)
+        return self._store_summary(_restore_omitted(response.text, omitted),
+                                   new_prescription, patient_id, role, batch=batch)
+    
+    def generate_both_summaries(self, new_prescription: Dict,
+                                existing_doctor_summary: Optional[str],
+                                existing_patient_summary: Optional[str],
+                                patient_id: str,
+                                batch: Optional[Dict[str, list]] = None) -> Dict[str, str]:
+        """
+        AUGMENTED GENERATION STEP (AG in RAG) for both roles in one Gemini call
+        The prescription data and task context are sent once instead of per role
+        """
+        doctor_context, doctor_omitted = _truncate_context(existing_doctor_summary)
+        patient_context, patient_omitted = _truncate_context(existing_patient_summary)
+        prompt = COMBINED_PROMPT.format_map({
+            "data": _compact_json(new_prescription),
+            "existing_doctor": doctor_context or NO_DOCTOR_SUMMARY,
+            "existing_patient": patient_context or NO_PATIENT_SUMMARY
+        })
         
-        response = self.model.generate_content(prompt)
-        summary = response.text
+        response = self.model.generate_content(prompt + COMBINED_INSTRUCTIONS)
         
+        try:
+            views = self._parse_gemini_json(response.text)
+            # Views are stored as text even if the model nested them as JSON
+            doctor_summary, patient_summary = (
+                view if isinstance(view, str) else json.dumps(view, ensure_ascii=False)
+                for view in (views["doctor_view"], views["patient_view"])
+            )
+            doctor_summary = _restore_omitted(doctor_summary, doctor_omitted)
+            patient_summary = _restore_omitted(patient_summary, patient_omitted)
+        except (ValueError, KeyError, TypeError) as e:
+            # Fall back to one call per role rather than losing the update
+            print(f"Error parsing combined summary JSON: {e}")
+            doctor_future = self._executor.submit(self.generate_summary, new_prescription,
+                                                  existing_doctor_summary, patient_id, "doctor", batch)
+            patient_future = self._executor.submit(self.generate_summary, new_prescription,
+                                                   existing_patient_summary, patient_id, "patient", batch)
+            return {
+                "doctor_view": doctor_future.result(),
+                "patient_view": patient_future.result()
+            }
+        
+        # Embed and store both views concurrently, then write metadata in one transaction
+        now = datetime.now()
+        doctor_future = self._executor.submit(self._store_summary, doctor_summary,
+                                              new_prescription, patient_id, "doctor", False, batch, now)
+        patient_future = self._executor.submit(self._store_summary, patient_summary,
+                                               new_prescription, patient_id, "patient", False, batch, now)
+        summaries = {
+            "doctor_view": doctor_future.result(),
+            "patient_view": patient_future.result()
+        }
+        self._save_summary_metadata(patient_id, {
+            "doctor": summaries["doctor_view"],
+            "patient": summaries["patient_view"]
+        }, new_prescription, now.isoformat())
+        
+        return summaries
+    
+    def _store_summary(self, summary, new_prescription: Dict, patient_id: str,
+                       role: str, save: bool = True,
+                       batch: Optional[Dict[str, list]] = None,
+                       now: Optional[datetime] = None) -> str:
+        """
+        Store an updated summary in the role's ChromaDB collection and metadata
+        With a batch, the ChromaDB write is queued for _flush_batch instead
+        """
         # Select the correct collection based on role
         collection = self.doctor_collection if role == "doctor" else self.patient_collection
         
         # Store updated summary in role-specific ChromaDB collection
-        doc_id = f"{patient_id}_{role}_{datetime.now().timestamp()}"
+        # One clock read per store, shared by the metadata and backup row
+        now = now or datetime.now()
+        timestamp = now.isoformat()
+        
+        # Concurrent stores for the same patient and role never share an id
+        with self._id_lock:
+            sequence = next(self._id_counter)
+        doc_id = f"{patient_id}_{role}_{time.time_ns()}_{sequence}"
         
        
 
         # MINIMAL METADATA - only primitives, no lists or nested objects
         clean_metadata = {
             "patient_id": patient_id,
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": timestamp,
             "role": role
         }
         
-        clean_metadata = self.sanitize_metadata(clean_metadata)
-
-                # Ensure summary is always a string
-       # Force summary into a string safe for ChromaDB
-        if isinstance(summary, list) or isinstance(summary, dict):
-          summary = json.dumps(summary, ensure_ascii=False)
+        # Arguments are only formatted when debug logging is enabled
+        logger.debug("summary type: %s", type(summary).__name__)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("metadata types: %s",
+                         {k: type(v).__name__ for k, v in clean_metadata.items()})
+        
+        if batch is not None:
+            batch[role].append((summary, clean_metadata, doc_id))
         else:
-          summary = str(summary)
-        print("DEBUG: type of summary =", type(summary))
-        print("DEBUG: type of clean_metadata =", type(clean_metadata))
-        # Just before collection.add()
-        for k, v in clean_metadata.items():
-           print(f"DEBUG metadata key: {k}, type: {type(v)}, value: {v}")
-
- 
-        try:
-            collection.add(
-                documents=[summary],  # The summary contains all the info
-                metadatas=[clean_metadata],  # Just for filtering
-                ids=[doc_id]
-            )
-        except Exception as e:
-            print(f"ChromaDB storage error: {e}")
-            print(f"Attempted metadata: {clean_metadata}")
+            try:
+                collection.add(
+                    documents=[summary],  # The summary contains all the info
+                    metadatas=[clean_metadata],  # Just for filtering
+                    ids=[doc_id]
+                )
+            except Exception as e:
+                print(f"ChromaDB storage error: {e}")
+                print(f"Attempted metadata: {clean_metadata}")
         
         # Store in metadata as backup with full prescription data
-        if patient_id not in self.metadata:
-            self.metadata[patient_id] = {}
+        if save:
+            self._save_summary_metadata(patient_id, {role: summary}, new_prescription, timestamp)
         
-        self.metadata[patient_id][f'latest_summary_{role}'] = summary
-        self.metadata[patient_id][f'latest_prescription_{role}'] = new_prescription
-        self.metadata[patient_id]['last_updated'] = datetime.now().isoformat()
-        self._save_metadata()
+        with self._summary_cache_lock:
+            self._summary_cache[(patient_id, role)] = summary
         
         return summary
     
+    def _flush_batch(self, batch: Dict[str, list]):
+        """Write queued summaries with one ChromaDB add per collection"""
+        for role, entries in batch.items():
+            if not entries:
+                continue
+            collection = self.doctor_collection if role == "doctor" else self.patient_collection
+            documents, metadatas, ids = (list(column) for column in zip(*entries))
+            try:
+                collection.add(documents=documents, metadatas=metadatas, ids=ids)
+            except Exception as e:
+                print(f"ChromaDB batch storage error ({role}, {len(ids)} summaries): {e}")
+            entries.clear()
+    
     def process_prescription(self, file_path: str, patient_id: str, 
                            file_type: str = "pdf") -> Dict[str, str]:
         """
@@ -331,45 +961,73 @@ class PrescriptionSummarizer:
         3. AUGMENT with new data and GENERATE updated summaries (AG)
         4. Return both doctor and patient views
         """
+        return self._run_pipeline(file_path, patient_id, file_type)
+    
+    def process_prescriptions(self, files: List[Tuple[str, str, str]],
+                              batch_size: int = 100) -> List[Dict]:
+        """
+        Run the pipeline over many (file_path, patient_id, file_type) entries
+        Summaries are written to ChromaDB in batches of up to batch_size per collection
+        """
+        batch = {"doctor": [], "patient": []}
+        results = []
+        try:
+            for file_path, patient_id, file_type in files:
+                results.append(self._run_pipeline(file_path, patient_id, file_type, batch))
+                if max(len(entries) for entries in batch.values()) >= batch_size:
+                    self._flush_batch(batch)
+        finally:
+            # Later prescriptions read the latest summary from the metadata store,
+            # so deferring these writes does not affect the rest of the run
+            self._flush_batch(batch)
+        return results
+    
+    def _run_pipeline(self, file_path: str, patient_id: str, file_type: str,
+                      batch: Optional[Dict[str, list]] = None) -> Dict[str, str]:
+        """Extract, retrieve and generate for one prescription file"""
         
-        # Step 1: Extract information from prescription
-        if file_type.lower() == "pdf":
-            text = self.extract_text_from_pdf(file_path)
-            prescription_data = self.extract_prescription_info(text)
-        elif file_type.lower() in ["jpg", "jpeg", "png"]:
-            # Use Gemini's vision directly for images (no OCR needed!)
-            prescription_data = self.process_image_directly(file_path)
-        else:
+        file_type = file_type.lower()
+        if file_type not in ("pdf", "jpg", "jpeg", "png"):
             raise ValueError("Unsupported file type. Use PDF or image formats.")
         
+        # Step 2 starts first: RETRIEVE existing summaries (RAG - Retrieval) - SEPARATE BY ROLE
+        # Retrieval does not depend on the new prescription, so both lookups
+        # run in the background while extraction waits on PyPDF2/Gemini
+        # Uncached: building on a stale summary would overwrite a newer one
+        doctor_future = self._executor.submit(self._query_summary, patient_id, "doctor")
+        patient_future = self._executor.submit(self._query_summary, patient_id, "patient")
+        
+        # Step 1: Extract information from prescription
+        # Re-uploads of the same file skip parsing and the Gemini extraction call
+        cache_file = self._extraction_cache_file(file_path)
+        prescription_data = self._load_cached_extraction(cache_file)
+        
+        if prescription_data is None:
+            if file_type == "pdf":
+                text = self.extract_text_from_pdf(file_path)
+                prescription_data = self.extract_prescription_info(text)
+            else:
+                # Use Gemini's vision directly for images (no OCR needed!)
+                prescription_data = self.process_image_directly(file_path)
+            
+            # Unparsed responses are not cached so a retry can do better
+            if "error" not in prescription_data:
+                self._save_cached_extraction(cache_file, prescription_data)
+        
         prescription_data["patient_id"] = patient_id
         
-        # Step 2: RETRIEVE existing summaries (RAG - Retrieval) - SEPARATE BY ROLE
-        existing_doctor_summary = self.get_existing_summary(patient_id, role="doctor")
-        existing_patient_summary = self.get_existing_summary(patient_id, role="patient")
+        existing_doctor_summary = doctor_future.result()
+        existing_patient_summary = patient_future.result()
         
         # Step 3: GENERATE summaries with AUGMENTATION (RAG - Augmented Generation)
-        # Each role gets its own existing summary context
-        doctor_summary = self.generate_summary(
-            prescription_data, existing_doctor_summary, patient_id, role="doctor"
-        )
-        
-        patient_summary = self.generate_summary(
-            prescription_data, existing_patient_summary, patient_id, role="patient"
+        # One Gemini call produces both views, each from its own existing summary
+        summaries = self.generate_both_summaries(
+            prescription_data, existing_doctor_summary, existing_patient_summary, patient_id,
+            batch
         )
         
         return {
-            "doctor_view": doctor_summary,
-            "patient_view": patient_summary,
+            "doctor_view": summaries["doctor_view"],
+            "patient_view": summaries["patient_view"],
             "extracted_data": prescription_data
         }
-    def sanitize_metadata(self,metadata: Dict) -> Dict[str, str]:
-      """Convert all metadata values into safe strings (no lists/dicts)."""
-      safe = {}
-      for k, v in metadata.items():
-         if isinstance(v, (list, dict)):
-            safe[k] = json.dumps(v)  # store as JSON string
-         else:
-            safe[k] = str(v)  # force everything else to string
-      return safe
- 
\ No newline at end of file